@@ -6,14 +6,18 @@ import sys
 import uuid
 import json
 import sqlite3
+import queue
 import random
+import time
 import hashlib
-import datetime
 import mimetypes
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from flask import (
-    Flask, request, render_template, render_template_string,
-    redirect, url_for, send_from_directory, flash, session, g
+    Flask, request, render_template,
+    redirect, url_for, send_from_directory, flash, session, g, abort
 )
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Try both EXIF libraries for safety
@@ -28,20 +32,54 @@ except ImportError:
     Image = None
     ExifTags = None
 
+_TAGS = ExifTags.TAGS if ExifTags else {}
+
+# BLAKE3 for upload hashing when available, SHA-256 otherwise
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+# orjson for serializing EXIF metadata when available, stdlib json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --------------------------------------------------------------------------------------
 # EXIF extraction
 # --------------------------------------------------------------------------------------
 
+# Leading bytes of image formats that can carry EXIF (JPEG, TIFF LE/BE, PNG)
+_EXIF_MAGICS = (b"\xff\xd8\xff", b"II*\x00", b"MM\x00*", b"\x89PNG\r\n\x1a\n")
+_HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1", b"avif"}
+
+def _may_have_exif(file_path):
+    """Sniff the file header so PDFs, text, archives etc. skip EXIF parsing entirely."""
+    with open(file_path, "rb") as f:
+        head = f.read(12)
+    if head.startswith(_EXIF_MAGICS):
+        return True
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS
+
 def extract_exif(file_path):
     """Try extracting EXIF metadata with Pillow, fallback to exifread if needed."""
     metadata = {}
+    try:
+        if not _may_have_exif(file_path):
+            return metadata
+    except OSError as e:
+        print("EXIF sniff error:", e)
+        return metadata
+
     try:
         if Image:
             with Image.open(file_path) as img:
                 info = img.getexif()
-                for tag, value in info.items():
-                    tag_name = ExifTags.TAGS.get(tag, tag)
-                    metadata[tag_name] = str(value)
+                tags_get = _TAGS.get
+                metadata = {tags_get(tag, tag): str(value) for tag, value in info.items()}
                 if metadata:
                     return metadata
     except Exception as e:
@@ -60,6 +98,35 @@ def extract_exif(file_path):
     return metadata
 
 
+# --------------------------------------------------------------------------------------
+# Upload helpers
+# --------------------------------------------------------------------------------------
+
+# Stored hashes are "<alg>:<hexdigest>" so they stay comparable if blake3 comes or goes
+CONTENT_HASH_ALG = "blake3" if blake3 else "sha256"
+
+def new_content_hasher():
+    """Return a fresh hasher for upload contents: BLAKE3 if installed, else SHA-256."""
+    return blake3() if blake3 else hashlib.sha256()
+
+@lru_cache(maxsize=256)
+def _mime_for_ext(ext):
+    # Stored names are uuid4 + extension, so the extension alone decides the type
+    return mimetypes.guess_type(f"file{ext}")[0] or "application/octet-stream"
+
+def _human_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def _dump_json(obj):
+    if orjson:
+        # Unknown EXIF tags keep their integer ids as keys
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+
 # --------------------------------------------------------------------------------------
 # Config
 # --------------------------------------------------------------------------------------
@@ -70,26 +137,94 @@ DB_PATH = os.path.join(BASE_DIR, "warehouse.db")
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-dandelion-key")
 app.config["UPLOAD_ROOT"] = os.path.join(BASE_DIR, "uploads")
+# Opt-in override for werkzeug's password hash method; unset keeps its scrypt default
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD")
+# Hand file bodies to the front-end web server (nginx/apache) instead of streaming them from Python
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
 os.makedirs(app.config["UPLOAD_ROOT"], exist_ok=True)
 
+# Compile templates once per process and keep the bytecode across restarts
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+app.jinja_env.auto_reload = False
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, ".jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
 ALLOW_GLOBAL_DOWNLOADS = True
+FILES_PER_PAGE = 50
+# Upper bound on ?page= so the OFFSET always fits in a SQLite INTEGER
+MAX_FILES_PAGE = 1_000_000
+
+# Random banners shown on the file listing page
+_DANDELION_BANNERS = (
+    "https://loremflickr.com/1200/400/dandelion",
+    "https://source.unsplash.com/random/1200x400/?dandelion",
+    "https://loremflickr.com/1200/400/flower,dandelion",
+    "https://picsum.photos/1200/400?blur=2&random=12",
+)
 
 # --------------------------------------------------------------------------------------
 # Template helpers
 # --------------------------------------------------------------------------------------
 
+@lru_cache(maxsize=64)
 def _template_exists(name: str) -> bool:
     return os.path.exists(os.path.join(BASE_DIR, "templates", name))
 
+@lru_cache(maxsize=64)
+def _missing_tpl(name: str):
+    return app.jinja_env.from_string(f"<pre>Missing template: {name}</pre>")
+
 def render(name: str, **ctx):
     if _template_exists(name):
         return render_template(name, **ctx)
-    return render_template_string(f"<pre>Missing template: {name}</pre>")
+    return _missing_tpl(name).render()
 
 # --------------------------------------------------------------------------------------
 # Database setup
 # --------------------------------------------------------------------------------------
 
+# Warm connections shared across requests; each request borrows one via get_db()
+# and hands it back in release_db(), so the db/-wal/-shm files stay open.
+_POOL = queue.Queue(maxsize=8)
+
+def _connect():
+    # Every query in this module is a fixed SQL string, so the per-connection
+    # statement cache keeps them all prepared for the life of the pooled connection.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    return conn
+
+def _borrow_conn():
+    try:
+        return _POOL.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+def _return_conn(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def get_db():
+    if "db" not in g:
+        g.db = _borrow_conn()
+    return g.db
+
+@app.teardown_request
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        _return_conn(conn)
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     conn.execute("""
@@ -111,30 +246,115 @@ def init_db():
             stored_name TEXT,
             mime_type TEXT,
             size_bytes INTEGER,
-            md5 TEXT,
+            content_hash TEXT,
             exif_json TEXT,
-            created_at TEXT,
+            exif_claimed_at TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     """)
+    # Covering index so login's email lookup never touches the users table itself
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_email_cover ON users(email, id, password_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user_created ON uploads(user_id, id DESC)")
     conn.commit()
-    conn.close()
+
+    # Databases created before the hash switch still carry the old column name.
+    # Check, rename, prefix and add columns under one write lock so concurrently starting
+    # workers can't race the ALTERs and a crash can't leave unprefixed md5 digests behind.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        upload_cols = [row[1] for row in conn.execute("PRAGMA table_info(uploads)")]
+        if "md5" in upload_cols:
+            conn.execute("ALTER TABLE uploads RENAME COLUMN md5 TO content_hash")
+            conn.execute("UPDATE uploads SET content_hash = 'md5:' || content_hash WHERE content_hash IS NOT NULL")
+        if "exif_claimed_at" not in upload_cols:
+            conn.execute("ALTER TABLE uploads ADD COLUMN exif_claimed_at TEXT")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# --------------------------------------------------------------------------------------
+# Background EXIF extraction
+# --------------------------------------------------------------------------------------
+
+# A single worker keeps EXIF parsing off the request path without piling up threads.
+# Nothing is submitted at import time, so servers that fork after importing the app
+# (gunicorn --preload, uWSGI) never inherit a running worker or a pooled connection.
+_EXIF_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exif")
+
+# Claims older than this are assumed lost (worker restarted) and may be retaken
+_EXIF_CLAIM_TIMEOUT = "-10 minutes"
+_exif_requeued_pid = None
+
+def _store_exif(upload_id, file_path):
+    try:
+        exif_data = extract_exif(file_path)
+        exif_json = _dump_json(exif_data) if exif_data else "{}"
+        conn = _borrow_conn()
+        try:
+            conn.execute("UPDATE uploads SET exif_json=? WHERE id=?", (exif_json, upload_id))
+        finally:
+            _return_conn(conn)
+    except Exception as e:
+        print("Background EXIF error:", e)
+
+@app.before_request
+def requeue_pending_exif():
+    """Once per serving process, queue EXIF work for uploads whose job was lost."""
+    global _exif_requeued_pid
+    if _exif_requeued_pid == os.getpid():
+        return
+    _exif_requeued_pid = os.getpid()
+
+    # Claim unfinished rows under a write lock so sibling workers don't repeat each other
+    conn = get_db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""
+            SELECT id, user_id, stored_name FROM uploads
+            WHERE exif_json IS NULL
+              AND (exif_claimed_at IS NULL OR exif_claimed_at < datetime('now', ?))
+        """, (_EXIF_CLAIM_TIMEOUT,)).fetchall()
+        conn.executemany(
+            "UPDATE uploads SET exif_claimed_at=CURRENT_TIMESTAMP WHERE id=?",
+            [(row[0],) for row in rows]
+        )
+    for upload_id, user_id, stored_name in rows:
+        full_path = os.path.join(app.config["UPLOAD_ROOT"], str(user_id), stored_name)
+        _EXIF_WORKER.submit(_store_exif, upload_id, full_path)
 
 
 # --------------------------------------------------------------------------------------
 # Load current user
 # --------------------------------------------------------------------------------------
 
+# Per-process cache of user rows: user_id -> (expires_at, row)
+_USER_CACHE_TTL = 60
+_USER_CACHE_MAX = 1024
+_user_cache = {}
+
+def _cached_user(user_id):
+    hit = _user_cache.get(user_id)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    row = get_db().execute("SELECT id, email, full_name FROM users WHERE id=?", (user_id,)).fetchone()
+    if row is not None:
+        if len(_user_cache) >= _USER_CACHE_MAX:
+            _user_cache.clear()
+        _user_cache[user_id] = (time.monotonic() + _USER_CACHE_TTL, row)
+    return row
+
 @app.before_request
 def load_logged_in_user():
     user_id = session.get("user_id")
     if user_id is None:
         g.user = None
     else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        g.user = conn.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
-        conn.close()
+        g.user = _cached_user(user_id)
 
 
 # --------------------------------------------------------------------------------------
@@ -164,19 +384,18 @@ def register_post():
         flash("Email and password required.")
         return redirect(url_for("register"))
 
-    pw_hash = generate_password_hash(password)
-    conn = sqlite3.connect(DB_PATH)
+    if app.config["PASSWORD_HASH_METHOD"]:
+        pw_hash = generate_password_hash(password, method=app.config["PASSWORD_HASH_METHOD"])
+    else:
+        pw_hash = generate_password_hash(password)
     try:
-        conn.execute(
+        get_db().execute(
             "INSERT INTO users (email, full_name, password_hash) VALUES (?, ?, ?)",
             (email, full_name, pw_hash)
         )
-        conn.commit()
     except sqlite3.IntegrityError:
         flash("That email is already registered.")
         return redirect(url_for("register"))
-    finally:
-        conn.close()
 
     flash("Account created successfully.")
     return redirect(url_for("login"))
@@ -193,9 +412,10 @@ def login_post():
     email = (request.form.get("email") or "").strip().lower()
     password = request.form.get("password") or ""
 
-    conn = sqlite3.connect(DB_PATH)
-    row = conn.execute("SELECT id, password_hash FROM users WHERE email=?", (email,)).fetchone()
-    conn.close()
+    # The planner prefers the UNIQUE(email) autoindex, so name the covering index explicitly
+    row = get_db().execute(
+        "SELECT id, password_hash FROM users INDEXED BY idx_users_email_cover WHERE email=?", (email,)
+    ).fetchone()
 
     if not row or not check_password_hash(row[1], password):
         flash("Invalid email or password.")
@@ -207,6 +427,7 @@ def login_post():
 
 @app.get("/logout")
 def logout():
+    _user_cache.pop(session.get("user_id"), None)
     session.clear()
     flash("Logged out.")
     return redirect(url_for("login"))
@@ -240,30 +461,40 @@ def do_upload():
 
     user_id = g.user["id"]
     user_dir = os.path.join(app.config["UPLOAD_ROOT"], str(user_id))
-    os.makedirs(user_dir, exist_ok=True)
     full_path = os.path.join(user_dir, stored)
-    f.save(full_path)
-
-    # EXIF extraction
-    exif_data = extract_exif(full_path)
-    exif_json = json.dumps(exif_data, ensure_ascii=False) if exif_data else "{}"
 
-    size_bytes = os.path.getsize(full_path)
-    mime_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
-
-    with open(full_path, "rb") as fh:
-        md5sum = hashlib.md5(fh.read()).hexdigest()
-
-    created_at = datetime.datetime.now().isoformat(timespec="seconds")
-
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""
-        INSERT INTO uploads (user_id, title, notes, original_name, stored_name, mime_type,
-                             size_bytes, md5, exif_json, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, title, notes, original, stored, mime_type, size_bytes, md5sum, exif_json, created_at))
-    conn.commit()
-    conn.close()
+    # Hash while saving so the upload is streamed once, in fixed-size chunks
+    h = new_content_hasher()
+    try:
+        out = open(full_path, "wb")
+    except FileNotFoundError:
+        # First upload for this user (or their directory was removed); create it and retry
+        os.makedirs(user_dir, exist_ok=True)
+        out = open(full_path, "wb")
+    with out:
+        for chunk in iter(lambda: f.stream.read(1 << 16), b""):
+            h.update(chunk)
+            out.write(chunk)
+        out.flush()
+        size_bytes = os.fstat(out.fileno()).st_size
+    content_hash = f"{CONTENT_HASH_ALG}:{h.hexdigest()}"
+
+    mime_type = _mime_for_ext(ext)
+
+    # Pooled connections run in autocommit mode, so open the transaction explicitly;
+    # the context manager commits it once (or rolls back) on exit.
+    # exif_json stays NULL until the background worker fills it in; this process
+    # claims the row so other workers don't requeue it.
+    conn = get_db()
+    with conn:
+        conn.execute("BEGIN")
+        cur = conn.execute("""
+            INSERT INTO uploads (user_id, title, notes, original_name, stored_name, mime_type,
+                                 size_bytes, content_hash, exif_claimed_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        """, (user_id, title, notes, original, stored, mime_type, size_bytes, content_hash))
+
+    _EXIF_WORKER.submit(_store_exif, cur.lastrowid, full_path)
 
     flash("File uploaded successfully.")
     return redirect(url_for("files"))
@@ -276,26 +507,46 @@ def files():
     if not g.user:
         return redirect(url_for("login"))
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    rows = conn.execute("""
-        SELECT id, title, original_name, stored_name, mime_type, size_bytes, created_at, exif_json
+    page = min(max(request.args.get("page", 1, type=int), 1), MAX_FILES_PAGE)
+
+    # Fetch one extra row to know whether there is a next page
+    rows = get_db().execute("""
+        SELECT id, title, original_name, stored_name, mime_type, size_bytes, created_at
         FROM uploads
         WHERE user_id = ?
         ORDER BY id DESC
-    """, (g.user["id"],)).fetchall()
-    conn.close()
+        LIMIT ? OFFSET ?
+    """, (g.user["id"], FILES_PER_PAGE + 1, (page - 1) * FILES_PER_PAGE)).fetchall()
+    has_next = len(rows) > FILES_PER_PAGE
+    rows = rows[:FILES_PER_PAGE]
+    # Human-readable sizes keyed by upload id, formatted once here rather than per render
+    sizes = {row["id"]: _human_size(row["size_bytes"] or 0) for row in rows}
 
     # Random dandelion banner
-    dandelions = [
-        "https://loremflickr.com/1200/400/dandelion",
-        "https://source.unsplash.com/random/1200x400/?dandelion",
-        "https://loremflickr.com/1200/400/flower,dandelion",
-        "https://picsum.photos/1200/400?blur=2&random=12"
-    ]
-    banner_url = random.choice(dandelions)
+    banner_url = random.choice(_DANDELION_BANNERS)
 
-    return render("files.html", files=rows, banner=banner_url)
+    return render("files.html", files=rows, sizes=sizes, banner=banner_url, page=page, has_next=has_next)
+
+
+# ---------------- EXIF metadata ----------------
+
+@app.get("/exif/<int:file_id>")
+def exif(file_id):
+    if not g.user:
+        return redirect(url_for("login"))
+
+    row = get_db().execute(
+        "SELECT exif_json FROM uploads WHERE id=? AND user_id=?", (file_id, g.user["id"])
+    ).fetchone()
+    if not row:
+        abort(404)
+
+    # NULL means the background worker has not finished with this file yet
+    if row[0] is None:
+        return app.response_class('{"pending": true}', status=202, mimetype="application/json")
+
+    # Stored already serialized, so pass it through without a decode/encode round trip
+    return app.response_class(row[0], mimetype="application/json")
 
 
 # ---------------- File download ----------------
@@ -305,21 +556,26 @@ def download(file_id):
     if not g.user:
         return redirect(url_for("login"))
 
-    conn = sqlite3.connect(DB_PATH)
-    row = conn.execute("SELECT stored_name, original_name, user_id FROM uploads WHERE id=?", (file_id,)).fetchone()
-    conn.close()
+    row = get_db().execute(
+        "SELECT stored_name, original_name, user_id, content_hash FROM uploads WHERE id=?", (file_id,)
+    ).fetchone()
 
     if not row:
         flash("File not found.")
         return redirect(url_for("files"))
 
-    stored_name, original_name, owner_id = row
+    stored_name, original_name, owner_id, content_hash = row
     if not ALLOW_GLOBAL_DOWNLOADS and owner_id != g.user["id"]:
         flash("Unauthorized download attempt.")
         return redirect(url_for("files"))
 
     owner_dir = os.path.join(app.config["UPLOAD_ROOT"], str(owner_id))
-    return send_from_directory(owner_dir, stored_name, as_attachment=True, download_name=original_name)
+    # Reuse the stored content hash as the ETag; conditional=True adds Range/304 support
+    response = send_from_directory(owner_dir, stored_name, as_attachment=True, download_name=original_name,
+                                   conditional=True, etag=content_hash or True)
+    # Files sit behind a login, so shared caches must not store them
+    response.cache_control.private = True
+    return response
 
 
 # --------------------------------------------------------------------------------------